@@ -1 +1,2 @@
 RESUME = False
+MAX_CONCURRENT_TRACKS = 50
@@ -1,9 +1,27 @@
+import functools
 import glob
 import pandas as pd
 import logging
 import unicodedata
 import re
 
+# Columns of the input csv files that are always read as strings, whatever their content looks like
+INPUT_STRING_COLUMNS = {"isrc": str, "artists": str, "song_name": str}
+
+# Patterns used by the string cleaning helpers, compiled once at import time
+_RE_PAREN = re.compile(r"[\(\[].*?[\)\]]")
+_RE_SPACES = re.compile(r" +")
+_RE_BRACKETS = re.compile(r"[\[\]\(\)/&]")
+# The featuring markers are removed in this order, one pass each: a single alternation gives different results when
+# the markers overlap (the "ft." pass can then consume the "f" of an adjacent "feat").
+_RE_FEATURING_MARKERS = (re.compile("featurering"), re.compile("feature"), re.compile("feat."), re.compile("ft."))
+_RE_NONALNUM = re.compile("[^A-Za-z0-9 \uac00-\ud7a3\u3040-\u30ff\u4e00-\u9FFF\u0400-\u04FF\u0E00-\u0E7F]+")
+_RE_KO = re.compile("[\uac00-\ud7a3]")
+_RE_JA = re.compile("[\u3040-\u30ff]")
+_RE_ZH = re.compile("[\u4e00-\u9FFF]")
+_RE_CY = re.compile("[\u0400-\u04FF]")
+_RE_TH = re.compile("[\u0E00-\u0E7F]")
+
 
 def build_dataframe(input_csv_dir, resume, output_csv_path, logger_name, subset=None):
     """
@@ -22,9 +40,15 @@ def build_dataframe(input_csv_dir, resume, output_csv_path, logger_name, subset=
 
     logger.info("Found {} csv files.".format(len(data_files)))
 
+    if len(data_files) == 0:
+        logger.error("No csv file found in {}.".format(input_csv_dir))
+        raise FileNotFoundError("No csv file found in {}.".format(input_csv_dir))
+
+    # Each file is parsed on its own so that a file cannot force its inferred types on the others, and pd.concat keeps
+    # the columns that only exist in some files. The identifiers and strings to be searched are always read as strings.
     dataframes = []
     for data_file in data_files:
-        df_tmp = pd.read_csv(data_file, index_col='isrc')
+        df_tmp = pd.read_csv(data_file, index_col='isrc', dtype=INPUT_STRING_COLUMNS)
         dataframes.append(df_tmp)
 
     df = pd.concat(dataframes, axis=0)
@@ -34,13 +58,14 @@ def build_dataframe(input_csv_dir, resume, output_csv_path, logger_name, subset=
 
     if resume:
         try:
-            df_output = pd.read_csv(output_csv_path, index_col="isrc")
-            df = df.drop(df_output.index)
+            # Only the isrc column of the output file is needed to know which tracks were already processed
+            output_index = pd.read_csv(output_csv_path, usecols=["isrc"], dtype={"isrc": str})["isrc"]
+            df = df[~df.index.isin(output_index)]
         except Exception as e:
             logger.error("Output file {} does not exist. Cannot resume.".format(output_csv_path))
 
     df = df.reset_index()
-    list_of_dict = list(df.T.to_dict().values())
+    list_of_dict = df.to_dict(orient="records")
     return list_of_dict
 
 
@@ -58,6 +83,14 @@ def write_dataframe(list_of_dict, output_csv_path, resume, logger_name):
     df = pd.DataFrame(list_of_dict).set_index("isrc")
     if resume:
         try:
+            # Only read the header of the existing output file
+            output_columns = pd.read_csv(output_csv_path, index_col="isrc", nrows=0).columns
+            if set(output_columns) == set(df.columns):
+                # Same columns as the existing output file: append the new rows without rewriting the file
+                logger.info("Appending to file {}.".format(output_csv_path))
+                df[output_columns].to_csv(output_csv_path, mode='a', header=False, index=True)
+                return True
+            # The columns differ: merge with the existing rows and rewrite the whole file
             dataframes = [df]
             df_output = pd.read_csv(output_csv_path, index_col="isrc")
             dataframes.append(df_output)
@@ -77,19 +110,19 @@ def cjk_detect(texts):
     :return: string - string describing the type of character detected
     """
     # korean
-    if re.search("[\uac00-\ud7a3]", texts):
+    if _RE_KO.search(texts):
         return "ko"
     # japanese
-    if re.search("[\u3040-\u30ff]", texts):
+    if _RE_JA.search(texts):
         return "ja"
     # chinese
-    if re.search("[\u4e00-\u9FFF]", texts):
+    if _RE_ZH.search(texts):
         return "zh"
     # cyrillic
-    if re.search('[\u0400-\u04FF]', texts):
+    if _RE_CY.search(texts):
         return "cy"
     # thai
-    if re.search('[\u0E00-\u0E7F]', texts):
+    if _RE_TH.search(texts):
         return "th"
     return None
 
@@ -100,7 +133,11 @@ def remove_accents(s):
     :param s: string - input string.
     :return: string - input string without any accent
     """
-    return ''.join((c for c in unicodedata.normalize('NFD', s) if unicodedata.category(c) != 'Mn'))
+    # ASCII strings have no accent: skip the normalization
+    if s.isascii():
+        return s
+    category = unicodedata.category
+    return ''.join((c for c in unicodedata.normalize('NFD', s) if category(c) != 'Mn'))
 
 
 def ct(input_str):
@@ -111,8 +148,8 @@ def ct(input_str):
     """
     """Clean title (ct)."""
     clean_str = str(input_str)
-    clean_str = re.sub("[\(\[].*?[\)\]]", " ", clean_str)
-    clean_str = re.sub(' +', ' ', clean_str)  # remove double spaces
+    clean_str = _RE_PAREN.sub(" ", clean_str)
+    clean_str = _RE_SPACES.sub(' ', clean_str)  # remove double spaces
     clean_str = clean_str.strip()  # remove leading and trailing spaces
     return clean_str
 
@@ -125,33 +162,61 @@ def cs(input_str):
     """
     clean_str = str(input_str)
     clean_str = clean_str.lower()
-    clean_str = re.sub("[\(\[].*?[\)\]]", " ", clean_str)
-    clean_str = clean_str.replace('[', ' ')
-    clean_str = clean_str.replace(']', ' ')
-    clean_str = clean_str.replace('(', ' ')
-    clean_str = clean_str.replace(')', ' ')
-    clean_str = re.sub("/", " ", clean_str)
-    clean_str = re.sub('&', ' ', clean_str)
+    clean_str = _RE_PAREN.sub(" ", clean_str)
+    clean_str = _RE_BRACKETS.sub(" ", clean_str)  # remove leftover brackets, slashes and ampersands
     clean_str = remove_accents(clean_str)
-    clean_str = re.sub('featurering', '', clean_str)
-    clean_str = re.sub('feature', '', clean_str)
-    clean_str = re.sub('feat.', '', clean_str)
-    clean_str = re.sub('ft.', '', clean_str)
-    clean_str = re.sub('[^A-Za-z0-9 \uac00-\ud7a3\u3040-\u30ff\u4e00-\u9FFF\u0400-\u04FF\u0E00-\u0E7F]+', ' ', clean_str)
-    clean_str = re.sub(' +', ' ', clean_str)  # remove double spaces
+    for featuring_marker in _RE_FEATURING_MARKERS:  # remove "featurering", "feature", "feat." and "ft."
+        clean_str = featuring_marker.sub('', clean_str)
+    clean_str = _RE_NONALNUM.sub(' ', clean_str)
+    clean_str = _RE_SPACES.sub(' ', clean_str)  # remove double spaces
     clean_str = clean_str.strip()  # remove leading and trailing spaces
 
     return clean_str
 
 
-def get_asymmetric_token_distance(str_short, str_long):
+@functools.lru_cache(maxsize=4096)
+def cached_cs(input_str):
     """
-    Custom calculation of some kind of normalized "distance" between a short and a long string. The distance will be
-    zero if the short string is composed of tokens (a continuous sequence of characters with no space) that are all
-    included in the longest string. If no token of the short string is included in the long string, the distance is 1.
-    :param str_short: the shortest string
-    :param str_long: the longest string
-    :return: float - token distance
+    Cached version of cs, for short strings repeated across tracks (artists, song names). Long strings that are
+    unique to a search result (metadata) should go through cs directly to keep the cache small.
+    :param input_str: string - Input string to be cleaned.
+    :return: clean_str: string - Output clean string.
+    """
+    return cs(input_str)
+
+
+def parse_duration(duration_str):
+    """
+    Converts a duration string as displayed by YouTube ("SS", "MM:SS" or "HH:MM:SS") to a number of seconds.
+    :param duration_str: string - the duration string.
+    :return: int - duration in seconds, None if the duration cannot be parsed
+    """
+    try:
+        return sum(int(part) * 60 ** i for i, part in enumerate(reversed(duration_str.split(':'))))
+    except (AttributeError, ValueError):
+        return None
+
+
+def field_to_str(value):
+    """
+    Converts a metadata field to a string. List fields (tags, categories) are joined with spaces: their str() would be
+    wrapped in brackets, which cs removes together with their content.
+    :param value: string, list or None - the metadata field.
+    :return: string - the field as a string, empty if the field is missing
+    """
+    if not value:
+        return ""
+    if isinstance(value, (list, tuple)):
+        return " ".join(str(item) for item in value)
+    return str(value)
+
+
+def prepare_tokens(str_short):
+    """
+    Splits a short string into the list of tokens used by token_distance. All the one letter tokens are merged into a
+    single token.
+    :param str_short: string - the shortest string
+    :return: tuple - list of tokens and the inverse of the number of tokens (distance added by each missing token)
     """
     # Split the short string to get the list of tokens
     token_short = str_short.split()
@@ -162,14 +227,27 @@ def get_asymmetric_token_distance(str_short, str_long):
     # Add one token with the one letter tokens previously detected
     if len(to_be_joined) > 0:
         token_short.append(' '.join(to_be_joined))
+    # Each missing token increases the distance by the same amount
+    inv_len = 1.0 / len(token_short) if len(token_short) > 0 else 0
+    return token_short, inv_len
+
+
+def token_distance(token_short, inv_len, str_long):
+    """
+    Computes the asymmetric token distance between a list of tokens prepared by prepare_tokens and a long string.
+    :param token_short: list - tokens of the shortest string
+    :param inv_len: float - inverse of the number of tokens, as returned by prepare_tokens
+    :param str_long: string - the longest string
+    :return: float - token distance
+    """
     # Initialize the distance and the list of tokens present in both strings
     dist = 0
     str_best_list = []
     # Loop over the token list
     for token in token_short:
         # If the token is not found in the long string, increase the distance
-        if not re.search(token, str_long):
-            dist += 1/len(token_short)
+        if token not in str_long:
+            dist += inv_len
         # The token is found in the long string, add it to the str_best_list list (for debugging)
         else:
             str_best_list.append(token)
@@ -178,3 +256,43 @@ def get_asymmetric_token_distance(str_short, str_long):
     str_best = ' '.join(str_best_list)
 
     return dist, str_best
+
+
+def get_asymmetric_token_distance(str_short, str_long):
+    """
+    Custom calculation of some kind of normalized "distance" between a short and a long string. The distance will be
+    zero if the short string is composed of tokens (a continuous sequence of characters with no space) that are all
+    included in the longest string. If no token of the short string is included in the long string, the distance is 1.
+    :param str_short: the shortest string
+    :param str_long: the longest string
+    :return: float - token distance
+    """
+    token_short, inv_len = prepare_tokens(str_short)
+    return token_distance(token_short, inv_len, str_long)
+
+
+def score_metadata(meta, artist_tokens, artist_inv_len, song_name_tokens, song_name_inv_len):
+    """
+    Cleans the meta string of a search result and computes the token distances of the artists and song_name to it.
+    This is the CPU heavy part of the extraction, it is kept at module level so that it can run in a process pool.
+    :param meta: string - raw meta string of the search result
+    :param artist_tokens: list - tokens of the artists, as returned by prepare_tokens
+    :param artist_inv_len: float - inverse of the number of artist tokens, as returned by prepare_tokens
+    :param song_name_tokens: list - tokens of the song_name, as returned by prepare_tokens
+    :param song_name_inv_len: float - inverse of the number of song_name tokens, as returned by prepare_tokens
+    :return: tuple - artist distance, artist tokens found, song_name distance, song_name tokens found and whether
+    "official" is in the meta string
+    """
+    # Clean the meta string removing accents, special characters, etc.
+    meta = cs(meta)
+
+    # Compute the token distance between the artists and the meta string (distance will be small if the artists
+    # can be found in meta)
+    artist_dist, artist_meta = token_distance(artist_tokens, artist_inv_len, meta)
+
+    # Compute the token distance between the song_name and the meta string (distance will be small if the song_name
+    # can be found in meta)
+    song_name_dist, song_name_meta = token_distance(song_name_tokens, song_name_inv_len, meta)
+    check_official = "official" in meta
+
+    return artist_dist, artist_meta, song_name_dist, song_name_meta, check_official
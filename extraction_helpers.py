@@ -1,136 +1,216 @@
+import asyncio
 import logging
+import multiprocessing
+import os
 import traceback
-import youtube_dl
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+import yt_dlp
 from youtube_search import YoutubeSearch
 from constants import youtube_url_prefix, YOUTUBE_LINK_EXTRACTOR_LOGGER
-from data_helpers import cs, ct, get_asymmetric_token_distance
-from multiprocessing import Lock
-from tenacity import retry, stop_after_attempt, wait_exponential
+from data_helpers import cs, cached_cs, ct, field_to_str, parse_duration, prepare_tokens, score_metadata, token_distance
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
 
 logger = logging.getLogger(YOUTUBE_LINK_EXTRACTOR_LOGGER)
 
-lock = Lock()
+# Search results whose preliminary confidence is lower than the best confidence minus this margin are skipped
+PRE_CONFIDENCE_MARGIN = 0.15
+
+# Results whose confidence is higher than this are assumed to be a good enough match
+GOOD_MATCH_CONFIDENCE = 0.8
+
+# Search results longer than this duration (in seconds) are ignored
+MAX_DURATION = 15 * 60
+
+# Fields of the yt_dlp metadata used to match a search result with the track. The music fields (artist, track, album,
+# alt_title, creator) are filled for YouTube Music and "Provided to YouTube by" uploads.
+META_FIELDS = ("title", "alt_title", "artist", "creator", "track", "album", "uploader", "description", "tags",
+               "categories")
+
+# Progress is logged every PROGRESS_LOG_INTERVAL tracks (and after the last one)
+PROGRESS_LOG_INTERVAL = 100
+
+# Progress counters, only updated from the event loop thread so no lock is needed
 count = 0
 total = 0
 succeeded = 0
 failed = 0
 
 
-@retry(stop=stop_after_attempt(5), wait=wait_exponential(multiplier=2, min=4, max=20))
-def extract_youtube_link(track):
+def search_youtube(search_terms, max_results=15):
+    """
+    Run a YouTube search. This is a blocking call, it is run in the executor of the event loop.
+    :param search_terms: string - the search query
+    :param max_results: int - maximum number of search results
+    :return: list - list of dictionaries describing the search results
+    """
+    return YoutubeSearch(search_terms, max_results=max_results).to_dict()
+
+
+def is_retryable(err):
+    """
+    Tells whether extract_youtube_link should be retried after an exception. A broken process pool will not recover:
+    retrying would only delay the failure of every remaining track.
+    :param err: Exception - the exception raised by extract_youtube_link
+    :return: bool - True if the extraction should be retried
+    """
+    return not isinstance(err, BrokenProcessPool)
+
+
+@retry(stop=stop_after_attempt(5), wait=wait_exponential(multiplier=2, min=4, max=20),
+       retry=retry_if_exception(is_retryable))
+async def extract_youtube_link(track, cpu_executor):
     """
     Find and extract the YouTube link corresponding to the input track.
     :param track: dict - dictionary of the track containing the three keys: artists, song_name and isrc.
+    :param cpu_executor: concurrent.futures.Executor - executor running the metadata cleaning and scoring
     :return: bool - True if the function ran successfully
     """
+    loop = asyncio.get_running_loop()
+
     # Get 15 YouTube search results based on the raw strings
     search_terms = track["artists"] + ' ' + track["song_name"] + ' official'
-    results_1 = YoutubeSearch(search_terms, max_results=15).to_dict()
+    results_1 = await loop.run_in_executor(None, search_youtube, search_terms)
 
     # Get 15 YouTube search results based on the raw artists string and the cleaned title string
-    search_terms = ct(search_terms)
-    results_2 = YoutubeSearch(search_terms, max_results=15).to_dict()
-
-    results = results_1 + results_2
+    # (skipped if cleaning the title does not change the search terms)
+    cleaned_search_terms = ct(search_terms)
+    results_2 = []
+    if cleaned_search_terms != search_terms:
+        results_2 = await loop.run_in_executor(None, search_youtube, cleaned_search_terms)
+    search_terms = cleaned_search_terms
+
+    # Remove the results found by both searches to avoid extracting their metadata twice
+    seen_url_suffixes = set()
+    results = []
+    for result in results_1 + results_2:
+        if result['url_suffix'] not in seen_url_suffixes:
+            seen_url_suffixes.add(result['url_suffix'])
+            results.append(result)
 
     track["search_terms"] = search_terms
-    track["cleaned_artist"] = cs(track["artists"])
-    track["cleaned_song_name"] = cs(track["song_name"])
-
-    # Loop over the search results
-    for res_idx, result in enumerate(results):
-
-        youtube_url = youtube_url_prefix + result['url_suffix']
-        ydl_opts = {'quiet': True}
-
-        # Extract metadata for the current results: meta is a long string with tons of info
-        with youtube_dl.YoutubeDL(ydl_opts) as ydl:
-            meta = ydl.extract_info(
-                youtube_url, download=False)
-
-        # Try to get track duration from the metadata
-        duration = 0
-        try:
-            duration = meta['duration']
-        except Exception:
-            logger.error("No duration in metadata.")
-
-        # Add more data to the meta string from the search result
-        meta = str(meta) + " "
-        try:
-            if "title" in result:
-                meta += result["title"] + " "
-        except Exception:
-            logger.error("Cannot add title to metadata.")
-
-        try:
-            if "long_desc" in result:
-                meta += result["long_desc"] + " "
-        except Exception:
-            logger.error("Cannot add long_desc to metadata.")
-
-        try:
-            if "channel" in result:
-                meta += result["channel"]
-        except Exception:
-            logger.error("Cannot add channel to metadata.")
-
-        # Clean the meta string removing accents, special characters, etc.
-        meta = cs(meta)
-
-        # Compute the token distance between the artists and the meta string (distance will be small if the artists
-        # can be found in meta)
-        artist_dist, artist_meta = get_asymmetric_token_distance(str_short=cs(track["artists"]), str_long=meta)
-
-        # Compute the token distance between the song_name and the meta string (distance will be small if the song_name
-        # can be found in meta)
-        song_name_dist, song_name_meta = get_asymmetric_token_distance(str_short=cs(track["song_name"]), str_long=meta)
-        check_official = "official" in meta
-
-        # Computes a score evaluating the confidence we have that the current result is a good match for the input track
-        # If neither of artists and song_name were found in the meta string, the score is 0.
-        # If both were found EXACTLY, the score is 1
-        # If one of them was found EXACTLY the score is 0.5
-        # All intermediate values are possible if only some words from the title were found in meta for example
-        confidence_score = ((1 - song_name_dist) + (1 - artist_dist)) / 2
-
-        # If the duration exceeds 15 minutes, ignore the current result
-        if duration >= 15*60:
-            confidence_score = 0
-
-        # Store the current result if it is the first search result of if the confidence is better than previous ones
-        if res_idx == 0 or confidence_score > track["youtube_url_confidence"]:
-            track["metadata_artist"] = artist_meta
-            track["artist_dist"] = artist_dist
-
-            track["metadata_song_name"] = song_name_meta
-            track["song_name_dist"] = song_name_dist
-
-            track["youtube_url_confidence"] = confidence_score
-
-            # Keep whether "official" is found in the meta string or not, for debugging and score tuning.
-            if check_official:
-                track["official"] = "TRUE"
-
-            track["youtube_url"] = youtube_url
-            track["result_idx"] = res_idx
-
-        # If the confidence score is higher than 0.8, assume it is a good enough match and break the loop
-        if track["youtube_url_confidence"] > 0.8:
-            break
-
+    track["cleaned_artist"] = cached_cs(track["artists"])
+    track["cleaned_song_name"] = cached_cs(track["song_name"])
+
+    # The tokens of the artists and song_name are the same for all the search results
+    artist_tokens, artist_inv_len = prepare_tokens(track["cleaned_artist"])
+    song_name_tokens, song_name_inv_len = prepare_tokens(track["cleaned_song_name"])
+
+    # Use a single YoutubeDL instance for all the search results of the track
+    ydl_opts = {'quiet': True, 'no_warnings': True, 'skip_download': True, 'extract_flat': 'in_playlist'}
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        # Loop over the search results
+        for res_idx, result in enumerate(results):
+
+            youtube_url = youtube_url_prefix + result['url_suffix']
+
+            # The search result usually gives the duration: skip the results that are too long without extracting
+            # their metadata
+            duration = parse_duration(result.get("duration"))
+            if res_idx > 0 and duration is not None and duration >= MAX_DURATION:
+                continue
+
+            # Compute a preliminary confidence score from the search result fields only. If it is too far below the best
+            # confidence so far, the full metadata is unlikely to make this result the best one: skip its extraction.
+            pre_meta = cs(" ".join(str(result.get(key) or "") for key in ("title", "long_desc", "channel")))
+            pre_artist_dist, pre_artist_meta = token_distance(artist_tokens, artist_inv_len, pre_meta)
+            pre_song_name_dist, pre_song_name_meta = token_distance(song_name_tokens, song_name_inv_len, pre_meta)
+            pre_confidence_score = ((1 - pre_song_name_dist) + (1 - pre_artist_dist)) / 2
+            if res_idx > 0 and pre_confidence_score <= track["youtube_url_confidence"] - PRE_CONFIDENCE_MARGIN:
+                continue
+
+            if pre_confidence_score > GOOD_MATCH_CONFIDENCE and duration is not None:
+                # The search result alone is a good enough match: accept it without extracting its metadata
+                match_source = "search_result"
+                artist_dist, artist_meta = pre_artist_dist, pre_artist_meta
+                song_name_dist, song_name_meta = pre_song_name_dist, pre_song_name_meta
+                check_official = "official" in pre_meta
+            else:
+                match_source = "metadata"
+
+                # Extract metadata for the current results: meta is a dictionary with tons of info. The formats are
+                # not processed since they are not used.
+                meta = await loop.run_in_executor(None, partial(ydl.extract_info, youtube_url, download=False,
+                                                                process=False))
+
+                # Try to get track duration from the metadata if the search result did not give it
+                if duration is None:
+                    duration = 0
+                    try:
+                        duration = meta['duration'] or 0
+                    except Exception:
+                        logger.error("No duration in metadata.")
+
+                # Build the meta string from the metadata fields carrying matching signal (formats, thumbnails, etc.
+                # are ignored) and add more data from the search result
+                meta_parts = [field_to_str(meta.get(key)) for key in META_FIELDS]
+                for key in ("title", "long_desc", "channel"):
+                    if key in result:
+                        if isinstance(result[key], str):
+                            meta_parts.append(result[key])
+                        else:
+                            logger.error("Cannot add {} to metadata.".format(key))
+                meta = " ".join(meta_parts)
+
+                # Clean the meta string and compute the token distances of the artists and song_name to it (distances
+                # will be small if they can be found in meta). This is CPU bound: run it outside of the event loop.
+                artist_dist, artist_meta, song_name_dist, song_name_meta, check_official = await loop.run_in_executor(
+                    cpu_executor, score_metadata,
+                    meta, artist_tokens, artist_inv_len, song_name_tokens, song_name_inv_len)
+
+            # Computes a score evaluating the confidence we have that the current result is a good match for the input
+            # track. If neither of artists and song_name were found in the meta string, the score is 0.
+            # If both were found EXACTLY, the score is 1
+            # If one of them was found EXACTLY the score is 0.5
+            # All intermediate values are possible if only some words from the title were found in meta for example
+            confidence_score = ((1 - song_name_dist) + (1 - artist_dist)) / 2
+
+            # If the duration exceeds 15 minutes, ignore the current result
+            if duration >= MAX_DURATION:
+                confidence_score = 0
+
+            # Store the current result if it is the first search result of if the confidence is better than previous
+            # ones
+            if res_idx == 0 or confidence_score > track["youtube_url_confidence"]:
+                track["metadata_artist"] = artist_meta
+                track["artist_dist"] = artist_dist
+
+                track["metadata_song_name"] = song_name_meta
+                track["song_name_dist"] = song_name_dist
+
+                track["youtube_url_confidence"] = confidence_score
+
+                # Keep whether "official" is found in the meta string or not, for debugging and score tuning.
+                if check_official:
+                    track["official"] = "TRUE"
+
+                track["youtube_url"] = youtube_url
+                track["result_idx"] = res_idx
+
+                # Keep whether the confidence was computed from the search result only or from the full metadata,
+                # for quality auditing (logged, not written to the output file).
+                best_match_source = match_source
+
+            # If the confidence score is higher than 0.8, assume it is a good enough match and break the loop
+            if track["youtube_url_confidence"] > GOOD_MATCH_CONFIDENCE:
+                break
+
+    logger.debug("Track {}: matched {} from {} with confidence {}.".format(
+        track["isrc"], track["youtube_url"], best_match_source, track["youtube_url_confidence"]))
     track["youtube_url_confidence"] = round(track["youtube_url_confidence"], 2)
     return True
 
 
-def perform_extraction(track, len_tracks):
+async def perform_extraction(track, len_tracks, semaphore, cpu_executor):
     """
     Run extraction for one track and check progress updating global counters
     :param track: dict - dictionary of the track containing the three keys: artists, song_name and isrc.
     :param len_tracks: int - total number of tracks to be processed
+    :param semaphore: asyncio.Semaphore - limits the number of tracks processed concurrently
+    :param cpu_executor: concurrent.futures.Executor - executor running the metadata cleaning and scoring
     :return: None
     """
-    global lock
     global count
     global total
     global succeeded
@@ -139,20 +219,38 @@ def perform_extraction(track, len_tracks):
     total = len_tracks
 
     try:
-        success = extract_youtube_link(track)
+        async with semaphore:
+            success = await extract_youtube_link(track, cpu_executor)
     except Exception as err:
         logger.error("Exception {}\nTraceback: {}".format(err, traceback.format_exc()))
         success = False
 
-    lock.acquire()
     count += 1
     if success:
         succeeded += 1
     else:
         failed += 1
 
-    if count % 2 == 0:
+    if (count % PROGRESS_LOG_INTERVAL == 0 or count == total) and logger.isEnabledFor(logging.INFO):
         status = round(100 * count / total, 2)
-        logger.info("Count: " + str(count) + "/" + str(total) + " - " + str(status) + "%")
-        logger.info("Succeeded: " + str(succeeded) + " - Failed = " + str(failed) + ".")
-    lock.release()
+        logger.info("Count: {}/{} - {}%\nSucceeded: {} - Failed = {}.".format(count, total, status, succeeded, failed))
+
+
+async def run_extraction(tracks, max_concurrent_tracks):
+    """
+    Run extraction for all the tracks concurrently on the event loop. The blocking YouTube calls are run in a thread
+    pool sized to the number of concurrent tracks, the CPU bound metadata scoring in a pool of one process per core.
+    The worker processes are spawned rather than forked, since forking while the YouTube threads are running can
+    deadlock the children.
+    :param tracks: list - list of track dictionaries
+    :param max_concurrent_tracks: int - maximum number of tracks processed at the same time
+    :return: list - results of perform_extraction for each track (exceptions are returned, not raised)
+    """
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=max_concurrent_tracks))
+    semaphore = asyncio.Semaphore(max_concurrent_tracks)
+    mp_context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=mp_context) as cpu_executor:
+        return await asyncio.gather(*[perform_extraction(track, len(tracks), semaphore, cpu_executor)
+                                      for track in tracks],
+                                    return_exceptions=True)
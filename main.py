@@ -1,19 +1,13 @@
 from constants import YOUTUBE_LINK_EXTRACTOR_LOGGER, INPUT_DIR, OUTPUT_DIR, OUTPUT_FILE_PATH, LOG_DIR
-from config import RESUME
+from config import RESUME, MAX_CONCURRENT_TRACKS
 from data_helpers import build_dataframe, write_dataframe
+import asyncio
 import logging
-from functools import partial
-from multiprocessing.pool import ThreadPool
-from extraction_helpers import perform_extraction
+from extraction_helpers import run_extraction
 import time
 import os
 
-# Initialize logger
-timestr = time.strftime("%Y%m%d-%H%M%S")
 logger = logging.getLogger(YOUTUBE_LINK_EXTRACTOR_LOGGER)
-logger.setLevel(logging.DEBUG)
-logger.addHandler(logging.FileHandler(str(LOG_DIR) + "/" + timestr + '-youtube_link_extractor.log'))
-logger.addHandler(logging.StreamHandler())
 
 
 if __name__ == '__main__':
@@ -23,6 +17,12 @@ if __name__ == '__main__':
     if not os.path.isdir(LOG_DIR):
         os.makedirs(LOG_DIR)
 
+    # Initialize logger (inside the main guard: the scoring worker processes import this module too)
+    timestr = time.strftime("%Y%m%d-%H%M%S")
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(logging.FileHandler(str(LOG_DIR) + "/" + timestr + '-youtube_link_extractor.log'))
+    logger.addHandler(logging.StreamHandler())
+
     logger.info("Starting YouTube Links Extractor.")
     # Load data
     tracks = build_dataframe(input_csv_dir=INPUT_DIR,
@@ -36,9 +36,8 @@ if __name__ == '__main__':
 
     if len(tracks) > 0:
         # Run extraction
-        with ThreadPool(10) as pool:
-            logger.info("Processing: " + str(len(tracks)) + " tracks.")
-            _ = pool.map(partial(perform_extraction, len_tracks=len(tracks)), tracks)
+        logger.info("Processing: " + str(len(tracks)) + " tracks.")
+        _ = asyncio.run(run_extraction(tracks, max_concurrent_tracks=MAX_CONCURRENT_TRACKS))
 
         write_dataframe(list_of_dict=tracks,
                         output_csv_path=OUTPUT_FILE_PATH,